@@ -1,8 +1,11 @@
 import streamlit as st
 import pandas as pd
-import json
+import orjson
+import csv
+import hashlib
 import os
-import re
+import pickle
+import tempfile
 from pathlib import Path
 from datetime import datetime
 
@@ -12,23 +15,106 @@ st.set_page_config(
     layout="centered"
 )
 
+# --- Review Section Headers (Literal Markers) ---
+_SECTION_HEADERS = (
+    ("Summary", "**Summary**"),
+    ("Strengths", "**Strengths**"),
+    ("Weaknesses", "**Weaknesses**"),
+    ("Questions", "**Questions**"),
+)
+
+# --- Results CSV Columns ---
+_RESULT_FIELDS = (
+    "timestamp",
+    "user",
+    "paper_id",
+    "review_type",
+    "reviewer_confidence",
+    "review_thoroughness",
+    "constructiveness",
+    "helpfulness",
+)
+
 # --- Data Loading (Cached for Performance) ---
+def load_json_with_pickle_cache(json_path):
+    """
+    Loads a JSON file, reusing a pickle sidecar built from the exact same JSON file.
+    """
+    json_path = Path(json_path)
+    pkl_path = json_path.with_suffix('.pkl')
+    json_stat = json_path.stat()
+    # Copies and unzips can give a newer file an older mtime, so require an exact match
+    source = (json_stat.st_size, json_stat.st_mtime_ns)
+    try:
+        with open(pkl_path, 'rb') as f:
+            sidecar = pickle.load(f)
+        if sidecar['source'] == source and hashlib.sha256(sidecar['payload']).hexdigest() == sidecar['sha256']:
+            return pickle.loads(sidecar['payload'])
+    except Exception:
+        # A missing, stale or corrupt sidecar is rebuilt from the JSON below
+        pass
+
+    with open(json_path, 'rb') as f:
+        data = orjson.loads(f.read())
+    payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    sidecar = {'source': source, 'sha256': hashlib.sha256(payload).hexdigest(), 'payload': payload}
+    # Write to a temp file and swap it in, so a failed write never leaves a truncated sidecar
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=pkl_path.parent, suffix='.pkl.tmp')
+    except OSError:
+        # The sidecar is only an optimisation; skip it if the folder is read-only
+        return data
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(sidecar, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, pkl_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return data
+
 @st.cache_data
-def load_data(data_folder):
+def load_user_df(data_folder):
     """
-    Loads all necessary CSV and JSON files for the rating task.
+    Loads the username -> annotator ID lookup and the sidebar user options.
     """
     try:
-        user_df = pd.read_csv(Path(data_folder) / "user.csv")
+        user_df = pd.read_csv(
+            Path(data_folder) / "user.csv",
+            usecols=lambda c: c.strip() in {'User', 'annotator_id'},
+            dtype='string',
+            skipinitialspace=True,
+        )
         user_df.columns = user_df.columns.str.strip()
-        with open(Path(data_folder) / "annotator_mapping.json", 'r', encoding='utf-8') as f:
-            annotator_map = json.load(f)
-        with open(Path(data_folder) / "combined_mapping.json", 'r', encoding='utf-8') as f:
-            all_reviews = json.load(f)
-        return user_df, annotator_map, all_reviews
+        # Username -> annotator ID, in the same order as user.csv
+        user_to_annotator = dict(zip(user_df['User'], user_df['annotator_id'].astype(str)))
+        # Sidebar options, built once instead of on every rerun
+        user_options = ("--- Select User ---",) + tuple(user_df['User'])
+        return user_to_annotator, user_options
     except FileNotFoundError as e:
         st.error(f"Error: A required data file was not found. Please check your './data' directory. Details: {e}")
-        return None, None, None
+        return None, None
+
+@st.cache_resource(ttl=3600)
+def load_mappings(data_folder):
+    """
+    Loads the annotator assignments and review texts.
+    Cached as a resource so every session shares one read-only copy; the TTL
+    picks up edits to the mapping files without restarting the app.
+    """
+    try:
+        annotator_map = load_json_with_pickle_cache(Path(data_folder) / "annotator_mapping.json")
+        # Assignments are read-only: store each queue as a tuple of (paper_id, review_type) tuples
+        annotator_map = {k: tuple((r[0], r[1]) for r in v) for k, v in annotator_map.items()}
+        all_reviews = load_json_with_pickle_cache(Path(data_folder) / "combined_mapping.json")
+        # Parsed reviews are keyed only on (paper_id, review_type), so drop them whenever the texts reload
+        get_parsed_review.clear()
+        return annotator_map, all_reviews
+    except FileNotFoundError as e:
+        st.error(f"Error: A required data file was not found. Please check your './data' directory. Details: {e}")
+        return None, None
 
 # --- Review Parsing Function ---
 def parse_review(review_text):
@@ -39,32 +125,41 @@ def parse_review(review_text):
         return {"Summary": ["Not Available"], "Strengths": [], "Weaknesses": [], "Questions": []}
 
     sections = {"Summary": [], "Strengths": [], "Weaknesses": [], "Questions": []}
-    summary_match = re.search(r'\*\*Summary\*\*(.*?)(?=\*\*Strengths\*\*|\Z)', review_text, re.DOTALL)
-    strengths_match = re.search(r'\*\*Strengths\*\*(.*?)(?=\*\*Weaknesses\*\*|\Z)', review_text, re.DOTALL)
-    weaknesses_match = re.search(r'\*\*Weaknesses\*\*(.*?)(?=\*\*Questions\*\*|\Z)', review_text, re.DOTALL)
-    questions_match = re.search(r'\*\*Questions\*\*(.*)', review_text, re.DOTALL)
-
-    if summary_match and summary_match.group(1).strip():
-        sections["Summary"].append(summary_match.group(1).strip())
-
-    for match, section_name in [(strengths_match, "Strengths"), (weaknesses_match, "Weaknesses"), (questions_match, "Questions")]:
-        if match:
-            content = match.group(1).strip()
-            # Split by newline and hyphen, then clean up each point
-            raw_points = content.split('\n-')
-            cleaned_points = []
-            for point in raw_points:
-                cleaned = point.strip()
-                # Remove a leading hyphen if it exists from the split
-                if cleaned.startswith('-'):
-                    cleaned = cleaned[1:].strip()
-                # Only add non-empty points
-                if cleaned:
-                    cleaned_points.append(cleaned)
-            sections[section_name] = cleaned_points
-            
+    # Headers are fixed literals, so locate them with str.find; each body runs up to the next header
+    headers = []
+    for section_name, tag in _SECTION_HEADERS:
+        pos = review_text.find(tag)
+        if pos != -1:
+            headers.append((pos, pos + len(tag), section_name))
+    headers.sort()
+
+    for i, (_, start, section_name) in enumerate(headers):
+        end = headers[i + 1][0] if i + 1 < len(headers) else len(review_text)
+        content = review_text[start:end].strip()
+
+        if section_name == "Summary":
+            if content:
+                sections["Summary"].append(content)
+            continue
+
+        # Split by newline and hyphen, remove a leftover leading hyphen and drop empty points
+        sections[section_name] = [
+            point
+            for point in (raw.strip().removeprefix('-').strip() for raw in content.split('\n-'))
+            if point
+        ]
+
     return sections
 
+@st.cache_data(show_spinner=False)
+def get_parsed_review(paper_id, review_type, _all_reviews):
+    """
+    Looks up and parses a single review, cached per (paper_id, review_type).
+    The leading underscore keeps Streamlit from hashing the full reviews dict.
+    """
+    review_text = _all_reviews.get(paper_id, {}).get(review_type, f"Review for Paper ID {paper_id} and type {review_type} not found.")
+    return parse_review(review_text)
+
 # --- Display and Save Functions ---
 def display_rating_form(review_data, review_key_prefix):
     """Displays a parsed review and inputs for four collective scores."""
@@ -90,43 +185,40 @@ def display_rating_form(review_data, review_key_prefix):
             st.number_input("Helpfulness", min_value=0.0, max_value=5.0, step=0.1, key=f"{review_key_prefix}_helpfulness")
 
 
-def save_results(results_path, record):
-    """Saves a single evaluation record to a CSV file."""
-    new_data = pd.DataFrame([record])
-    if os.path.exists(results_path):
-        results_df = pd.read_csv(results_path)
-        combined_df = pd.concat([results_df, new_data], ignore_index=True)
-    else:
-        combined_df = new_data
-    combined_df.to_csv(results_path, index=False)
+def flush_results(results_path, records):
+    """Appends buffered evaluation records to a CSV file and empties the buffer."""
+    if not records:
+        return
+    file_exists = os.path.exists(results_path)
+    # Append the new rows instead of rewriting the whole file
+    with open(results_path, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=_RESULT_FIELDS, lineterminator='\n')
+        if not file_exists:
+            writer.writeheader()
+        writer.writerows(records)
+    records.clear()
 
 def check_if_all_rated(review_key_prefix):
     """Validates that all four score inputs have non-zero values."""
-    score_keys = [
-        f"{review_key_prefix}_confidence",
-        f"{review_key_prefix}_thoroughness",
-        f"{review_key_prefix}_constructiveness",
-        f"{review_key_prefix}_helpfulness"
-    ]
-    for key in score_keys:
-        if st.session_state[key] == 0.0:
-            return False
-    return True
+    return all(
+        st.session_state.get(f"{review_key_prefix}_{score}", 0.0) != 0.0
+        for score in ("confidence", "thoroughness", "constructiveness", "helpfulness")
+    )
+
+# Each write gives the file a new mtime; bound the cache so stale keys get evicted
+# (a few entries per annotator in user.csv is plenty)
+@st.cache_data(show_spinner=False, max_entries=64)
+def _count_user_reviews(results_path, user, mtime):
+    """Counts a user's rows in the results CSV; `mtime` invalidates the cache on writes."""
+    with open(results_path, 'r', newline='', encoding='utf-8') as f:
+        return sum(1 for row in csv.DictReader(f) if row.get('user') == user)
 
 def get_user_progress(results_path, user):
     """Checks how many reviews a user has already completed."""
-    if not os.path.exists(results_path):
-        return 0
     try:
-        results_df = pd.read_csv(results_path)
-        if results_df.empty:
-            return 0
-        user_reviews = results_df[results_df['user'] == user]
-        return len(user_reviews)
-    except (pd.errors.EmptyDataError, FileNotFoundError):
-        return 0
+        return _count_user_reviews(str(results_path), user, os.path.getmtime(results_path))
     except Exception:
-        # In case of other errors reading the file, default to 0
+        # A missing results file or any other read error counts as no progress
         return 0
 
 # --- Main Application ---
@@ -135,29 +227,42 @@ st.title("📝 Review Evaluation Task")
 DATA_FOLDER = Path("./data")
 RESULTS_CSV_PATH = DATA_FOLDER / 'evaluation_results.csv'
 
-user_df, annotator_map, all_reviews = load_data(DATA_FOLDER)
+user_to_annotator, user_options = load_user_df(DATA_FOLDER)
+annotator_map, all_reviews = load_mappings(DATA_FOLDER)
 
-if user_df is None:
+# Don't keep serving a failed load from the cache
+if user_options is None:
+    load_user_df.clear()
+if annotator_map is None:
+    load_mappings.clear()
+if user_options is None or annotator_map is None:
     st.stop()
 
+# Submissions are buffered in session state and written out at the start of the
+# next rerun, which st.rerun() triggers server-side right after the submit
+if st.session_state.get('pending_records'):
+    flush_results(RESULTS_CSV_PATH, st.session_state.pending_records)
+    st.toast("Rating submitted!", icon="✅")
+
 # --- User Login and Session State Initialization ---
 st.sidebar.header("👤 Annotator Selection")
-users = ["--- Select User ---"] + user_df['User'].tolist()
-selected_user = st.sidebar.selectbox("Select your username:", users)
+selected_user = st.sidebar.selectbox("Select your username:", user_options)
 
 if selected_user != "--- Select User ---":
     # Initialize session state for the user
     if 'user' not in st.session_state or st.session_state.user != selected_user:
         st.session_state.user = selected_user
+        st.session_state.pending_records = []
         
         # Check for previous progress
         completed_count = get_user_progress(RESULTS_CSV_PATH, selected_user)
         st.session_state.review_index = completed_count
         
         # Get the user's annotator ID
-        annotator_id = user_df[user_df['User'] == selected_user]['annotator_id'].iloc[0]
+        annotator_id = user_to_annotator[selected_user]
         # Get the list of reviews assigned to this annotator
-        st.session_state.review_queue = annotator_map.get(str(annotator_id), [])
+        st.session_state.review_queue = annotator_map.get(annotator_id, ())
+        st.session_state.review_total = len(st.session_state.review_queue)
 
     # --- Main Display Logic ---
     if not st.session_state.review_queue:
@@ -165,7 +270,7 @@ if selected_user != "--- Select User ---":
         st.stop()
 
     # Check if the user has completed all reviews
-    if st.session_state.review_index >= len(st.session_state.review_queue):
+    if st.session_state.review_index >= st.session_state.review_total:
         st.success("🎉 You have completed all your assigned reviews. Thank you!")
         st.balloons()
         st.stop()
@@ -174,10 +279,11 @@ if selected_user != "--- Select User ---":
     current_review_info = st.session_state.review_queue[st.session_state.review_index]
     paper_id, review_type = current_review_info
     
-    review_text = all_reviews.get(paper_id, {}).get(review_type, f"Review for Paper ID {paper_id} and type {review_type} not found.")
-    parsed_review = parse_review(review_text)
+    # all_reviews is the shared cache_resource dict; it is passed by reference and,
+    # as an underscore argument, never hashed or copied by get_parsed_review's cache
+    parsed_review = get_parsed_review(paper_id, review_type, all_reviews)
 
-    st.header(f"Review {st.session_state.review_index + 1} of {len(st.session_state.review_queue)}")
+    st.header(f"Review {st.session_state.review_index + 1} of {st.session_state.review_total}")
     
     review_key_prefix = f"review_{st.session_state.review_index}"
 
@@ -189,7 +295,7 @@ if selected_user != "--- Select User ---":
             if not check_if_all_rated(review_key_prefix):
                 st.error("Please enter a non-zero value for all four scores.")
             else:
-                # Collect and save the single record
+                # Collect the record and buffer it for the flush at the start of the next rerun
                 record = {
                     "timestamp": datetime.now().isoformat(),
                     "user": selected_user,
@@ -201,8 +307,7 @@ if selected_user != "--- Select User ---":
                     "helpfulness": st.session_state[f"{review_key_prefix}_helpfulness"],
                 }
                 
-                save_results(RESULTS_CSV_PATH, record)
-                st.toast("Rating submitted!", icon="✅")
+                st.session_state.pending_records.append(record)
                 
                 # Advance to the next review
                 st.session_state.review_index += 1